@@ -47,6 +47,8 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     self.logic = None
     self._parameterNode = None
     self._updatingGUIFromParameterNode = False
+    self._cliNode = None  # CLI module node of the processing in progress
+    self._outputSegmentation = None
 
   def setup(self):
     """
@@ -90,6 +92,7 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     # (in the selected parameter node).
     self.ui.inputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.inputSeedSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    self.ui.inputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onInputVolumeChanged)
 
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
@@ -101,6 +104,7 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     """
     Called when the application closes and the module widget is destroyed.
     """
+    self.cancelProcessing()
     self.removeObservers()
 
   def enter(self):
@@ -109,6 +113,8 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     """
     # Make sure parameter node exists and observed
     self.initializeParameterNode()
+    # Load what the first Apply needs while the user is placing the seed point
+    qt.QTimer.singleShot(500, self.logic.warmUp)
 
   def exit(self):
     """
@@ -121,6 +127,8 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     """
     Called just before the scene is closed.
     """
+    # Results of a processing in progress would be imported into a node of the closed scene
+    self.cancelProcessing()
     # Parameter node will be reset, do not use it anymore
     self.setParameterNode(None)
 
@@ -192,7 +200,11 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     self.ui.outputSegmentationSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputSegmentation"))
 
     # Update buttons states and tooltips
-    if self._parameterNode.GetNodeReference("InputVolume") and self._parameterNode.GetNodeReference("InputSeed"):
+    if self._cliNode:
+      # Processing is in progress, the button can be used for cancelling it
+      self.ui.applyButton.toolTip = "Cancel airway segmentation"
+      self.ui.applyButton.enabled = True
+    elif self._parameterNode.GetNodeReference("InputVolume") and self._parameterNode.GetNodeReference("InputSeed"):
       self.ui.applyButton.toolTip = "Compute airway segmentation"
       self.ui.applyButton.enabled = True
     else:
@@ -219,11 +231,34 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
     self._parameterNode.EndModify(wasModified)
 
+  def onInputVolumeChanged(self, inputVolume):
+    """
+    Look up the convolution kernel of the new input volume while the user is placing the seed point,
+    so that the DICOM database query is not done when Apply is clicked.
+    The lookup is deferred to let the GUI update first. It is not done in a worker thread,
+    because the DICOM database can only be accessed from the main thread.
+    """
+    if not inputVolume:
+      return
+    inputVolumeID = inputVolume.GetID()
+    qt.QTimer.singleShot(0, lambda: self._prefetchConvolutionKernel(inputVolumeID))
+
+  def _prefetchConvolutionKernel(self, inputVolumeID):
+    inputVolume = slicer.mrmlScene.GetNodeByID(inputVolumeID)
+    if inputVolume:
+      # The result is cached in the logic
+      self.logic.convolutionKernelFromVolumeNode(inputVolume)
+
   def onApplyButton(self):
     """
     Run processing when user clicks "Apply" button.
+    The button cancels the processing if it is already in progress.
     """
 
+    if self._cliNode:
+      self._cliNode.Cancel()
+      return
+
     # Get convolution kernel
     inputVolume = self.ui.inputVolumeSelector.currentNode()
     convolutionKernel = self.logic.convolutionKernelFromVolumeNode(inputVolume)
@@ -235,7 +270,6 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         return False
 
     self.ui.applyButton.enabled = False
-    slicer.app.processEvents()
 
     with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
@@ -245,22 +279,76 @@ class AirwaySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', slicer.mrmlScene.GetUniqueNameByString('Airway'))
         self.ui.outputSegmentationSelector.setCurrentNode(segmentationNode)
 
-      # Compute output
-      self.logic.process(inputVolume, self.ui.inputSeedSelector.currentNode(), segmentationNode)
-      self.logic.show3D(segmentationNode)
+      # Start computing output. The CLI runs in the background, results are imported in onCliStatusModified.
+      cliNode = self.logic.process(inputVolume, self.ui.inputSeedSelector.currentNode(), segmentationNode, convolutionKernel,
+        waitForCompletion=False)
+      if cliNode:
+        self._cliNode = cliNode
+        self._outputSegmentation = segmentationNode
+        # Both status and progress changes are notified by ModifiedEvent
+        self.addObserver(cliNode, vtk.vtkCommand.ModifiedEvent, self.onCliStatusModified)
+        self.ui.applyButton.text = "Cancel"
+      else:
+        self.logic.show3D(segmentationNode)
 
-    self.ui.applyButton.enabled = True
+    self.updateGUIFromParameterNode()
+
+  def cancelProcessing(self):
+    """
+    Stop the processing in progress and discard its results.
+    """
+    if not self._cliNode:
+      return
+    cliNode = self._cliNode
+    self.removeObserver(cliNode, vtk.vtkCommand.ModifiedEvent, self.onCliStatusModified)
+    self._cliNode = None
+    self._outputSegmentation = None
+    self.logic.cancelProcess(cliNode)
+    self.ui.applyButton.text = "Apply"
+
+  def onCliStatusModified(self, cliNode, event):
+    """
+    Show progress of the CLI and import the results when it is completed.
+    """
+    if cliNode.IsBusy():
+      self.ui.applyButton.text = f"Cancel ({cliNode.GetProgress() * 100:.0f}%)"
+      return
+
+    self.removeObserver(cliNode, vtk.vtkCommand.ModifiedEvent, self.onCliStatusModified)
+    self._cliNode = None
+    self.ui.applyButton.text = "Apply"
+
+    with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
+      if self.logic.finishProcess(cliNode):
+        self.logic.show3D(self._outputSegmentation)
+
+    self._outputSegmentation = None
+    self.updateGUIFromParameterNode()
 
   # def onBronchoscopyButton(self):
   #   self.bronchoscopyButton.enabled = True
   #   mainWindow = slicer.util.mainWindow()
   #   mainWindow.moduleSelector().selectModule('Bronchoscopy')
 
+class _WidgetShowEventFilter(qt.QObject):
+  """
+  Event filter that calls a function when the widget that it is installed on is shown.
+  """
+
+  def __init__(self, callback):
+    qt.QObject.__init__(self)
+    self.callback = callback
+
+  def eventFilter(self, obj, event):
+    if event.type() == qt.QEvent.Show:
+      self.callback()
+    return False
+
 #
 # AirwaySegmentationLogic
 #
 
-class AirwaySegmentationLogic(ScriptedLoadableModuleLogic):
+class AirwaySegmentationLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
   """This class should implement all the actual
   computation done by your module.  The interface
   should be such that other python code can import
@@ -275,6 +363,20 @@ class AirwaySegmentationLogic(ScriptedLoadableModuleLogic):
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    VTKObservationMixin.__init__(self)  # needed for scene observation
+    # Input volume converted to int16 voxel type, reused as long as the input volume is not modified
+    self._int16InputVolume = None
+    self._int16InputVolumeKey = None
+    # Convolution kernel of DICOM instances, to avoid repeated DICOM database queries
+    self._kernelCache = {}
+    # Hidden labelmap volume that receives the CLI output, reused across runs
+    self._tmpLabel = None
+    # Output, temporary labelmap and start time of each processing that is waiting for finishProcess, by CLI node ID
+    self._pendingProcesses = {}
+    # Segmentation to show in 3D when a 3D view becomes visible
+    self._pending3DSegmentation = None
+    self._threeDWidget = None
+    self._threeDWidgetShowEventFilter = None
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -282,13 +384,17 @@ class AirwaySegmentationLogic(ScriptedLoadableModuleLogic):
     """
     pass
 
-  def process(self, inputVolume, inputSeed, outputSegmentation):
+  def process(self, inputVolume, inputSeed, outputSegmentation, convolutionKernel=None, waitForCompletion=True):
     """
     Run the processing algorithm.
     Can be used without GUI widget.
     :param inputVolume: input CT volume to segment the airways from
     :param inputSeed: markup point node containint a single point in the trachea
     :param outputSegmentation: segmentation result
+    :param convolutionKernel: convolution kernel of the input volume. If not specified then it is retrieved from the DICOM database.
+    :param waitForCompletion: if False then the method returns as soon as the CLI is started, the CLI node
+      is returned, and finishProcess must be called with the CLI node when it is no longer busy.
+    :return: CLI module node if the processing is still in progress, None if it is completed
     """
 
     if not inputVolume or not inputSeed or not outputSegmentation:
@@ -300,70 +406,359 @@ class AirwaySegmentationLogic(ScriptedLoadableModuleLogic):
 
 
     # Get convolution kernel
-    convolutionKernel = self.convolutionKernelFromVolumeNode(inputVolume)
+    if convolutionKernel is None:
+      convolutionKernel = self.convolutionKernelFromVolumeNode(inputVolume)
     if not convolutionKernel:
       logging.warning("Convolution kernel is unknown, STANDARD will be used.")
       convolutionKernel = "STANDARD"
 
     # Compute the segmentation
-    tmpLabelVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-    tmpLabelVolume.CreateDefaultDisplayNodes()
-    tmpLabelVolume.GetDisplayNode().SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileGenericAnatomyColors.txt')
+    tmpLabelVolume = self._getTemporaryLabelVolume()
     labelValue = 170  # trachea in GenericAnatomyColors
-    parameters = {
-        "inputVolume": inputVolume.GetID(),
-        "reconstructionKernelType": convolutionKernel,
-        "label": tmpLabelVolume.GetID(),
-        "seed": inputSeed.GetID(),
-        "labelValue": labelValue,
-        }
-    cliNode = slicer.cli.run(slicer.modules.airwaysegmentationcli, None, parameters, wait_for_completion = True)
+    pendingProcess = {"outputSegmentation": outputSegmentation, "labelVolume": tmpLabelVolume, "startTime": startTime}
+    seedIJK = self.seedIJKFromMarkup(inputVolume, inputSeed)
+    if hasattr(slicer.modules, "airwaysegmentationcli"):
+      parameters = {
+          "inputVolume": self._getInt16InputVolume(inputVolume).GetID(),
+          "reconstructionKernelType": convolutionKernel,
+          "label": tmpLabelVolume.GetID(),
+          "seed": inputSeed.GetID(),
+          # Seed voxel is computed here so that the CLI does not need to transform the seed point position
+          "seedIJK": ",".join(str(c) for c in seedIJK),
+          "labelValue": labelValue,
+          "numberOfThreads": os.cpu_count() or 0,
+          }
+      cliNode = slicer.cli.run(slicer.modules.airwaysegmentationcli, None, parameters, wait_for_completion = waitForCompletion)
+      self._pendingProcesses[cliNode.GetID()] = pendingProcess
+      if not waitForCompletion:
+        return cliNode
+      self.finishProcess(cliNode)
+    else:
+      logging.warning("Airway Segmentation CLI module is not available, simple region growing will be used.")
+      volumeArray = slicer.util.arrayFromVolume(inputVolume)
+      # No lower threshold, upper threshold is the starting threshold that the CLI uses for the trachea
+      labelArray = self._growFallback(volumeArray, seedIJK, float(volumeArray.min()), -900.0, labelValue)
+      tmpLabelVolume.CopyOrientation(inputVolume)
+      slicer.util.updateVolumeFromArray(tmpLabelVolume, labelArray)
+      self._importResult(pendingProcess)
+
+    return None
+
+  def finishProcess(self, cliNode):
+    """
+    Import the segmentation result into the output segmentation.
+    Called by process, or by the caller of process if it did not wait for completion of the CLI.
+    :param cliNode: CLI module node returned by process
+    :return: True if the output segmentation is updated, False if the processing was cancelled
+    """
+
+    pendingProcess = self._pendingProcesses.pop(cliNode.GetID())
+
+    status = cliNode.GetStatus()
+    errorText = cliNode.GetErrorText()
     # We don't need the CLI module node anymore, remove it to not clutter the scene with it
     slicer.mrmlScene.RemoveNode(cliNode)
+    if status != slicer.vtkMRMLCommandLineModuleNode.Completed:
+      self._releaseTemporaryLabelVolume(pendingProcess["labelVolume"])
+      if status == slicer.vtkMRMLCommandLineModuleNode.Cancelled:
+        logging.info('Processing cancelled')
+        return False
+      raise ValueError(f"Airway segmentation CLI failed: {errorText}")
+
+    self._importResult(pendingProcess)
+    return True
+
+  def cancelProcess(self, cliNode):
+    """
+    Stop a processing that process returned without waiting for completion, and discard its results.
+    finishProcess must not be called for this CLI node.
+    """
+    pendingProcess = self._pendingProcesses.pop(cliNode.GetID(), None)
+    if cliNode.IsBusy():
+      cliNode.Cancel()
+    if pendingProcess:
+      self._releaseTemporaryLabelVolume(pendingProcess["labelVolume"])
+
+  def _importResult(self, pendingProcess):
+    """
+    Import the segmentation result from the temporary labelmap volume into the output segmentation.
+    """
+    outputSegmentation = pendingProcess["outputSegmentation"]
+    tmpLabelVolume = pendingProcess["labelVolume"]
+
+    # All MRML scene changes are done in a single batch to avoid repeated updates of the views and widgets
+    slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      # Convert result to segmentation node
+      # Segment update and property changes are applied to the segmentation node in one batch
+      wasModified = outputSegmentation.StartModify()
+      try:
+        segmentation = outputSegmentation.GetSegmentation()
+        # Use a lower smoothing than the default 0.5 to ensure that thin airways are not suppressed in the 3D output.
+        # The parameter is set before updating the labelmap, because if the segmentation already contains a closed surface
+        # representation then that is computed during the update and it would not be updated when the parameter is changed.
+        segmentation.SetConversionParameter("Smoothing factor","0.2")
+        labelmapGeometry = self._labelmapGeometry(tmpLabelVolume)
+        segmentId = self._previousAirwaySegmentId(outputSegmentation, labelmapGeometry)
+        if segmentId:
+          # Re-run on the same output with the same geometry: replace the voxels of the airway segment of the previous run
+          # instead of removing it and importing a new segment, so that the segment ID and the display properties are kept.
+          labelmapImage = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(tmpLabelVolume)
+          try:
+            slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(labelmapImage, outputSegmentation, segmentId,
+              slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, labelmapImage.GetExtent())
+          finally:
+            # The image is a new object that the caller owns
+            labelmapImage.UnRegister(None)
+        else:
+          segmentation.RemoveAllSegments()
+          slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(tmpLabelVolume, outputSegmentation)
+
+          segmentId = segmentation.GetNthSegmentID(0)
+          segment = segmentation.GetSegment(segmentId)
+          segment.SetTag(segment.GetTerminologyEntryTagName(),
+            "Segmentation category and type - 3D Slicer General Anatomy list"
+            "~SCT^123037004^Anatomical Structure"
+            "~SCT^44567001^Trachea"
+            "~^^"
+            "~Anatomic codes - DICOM master list"
+            "~^^"
+            "~^^")
+        # Remember the segment so that it can be updated in place when the segmentation is computed again
+        outputSegmentation.SetAttribute("AirwaySegmentation.SegmentID", segmentId)
+        outputSegmentation.SetAttribute("AirwaySegmentation.LabelmapGeometry", labelmapGeometry)
+      finally:
+        outputSegmentation.EndModify(wasModified)
+    finally:
+      self._releaseTemporaryLabelVolume(tmpLabelVolume)
+      slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
 
-    # Convert result to segmentation node
-    outputSegmentation.GetSegmentation().RemoveAllSegments()
-    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(tmpLabelVolume, outputSegmentation)
-    # Use a lower smoothing than the default 0.5 to ensure that thin airways are not suppressed in the 3D output
-    outputSegmentation.GetSegmentation().SetConversionParameter("Smoothing factor","0.2")
-
-    segmentId = outputSegmentation.GetSegmentation().GetNthSegmentID(0)
-    segment = outputSegmentation.GetSegmentation().GetSegment(segmentId)
-    segment.SetTag(segment.GetTerminologyEntryTagName(),
-      "Segmentation category and type - 3D Slicer General Anatomy list"
-      "~SCT^123037004^Anatomical Structure"
-      "~SCT^44567001^Trachea"
-      "~^^"
-      "~Anatomic codes - DICOM master list"
-      "~^^"
-      "~^^")
-
-    slicer.mrmlScene.RemoveNode(tmpLabelVolume)
-
+    import time
     stopTime = time.time()
-    logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+    logging.info(f'Processing completed in {stopTime-pendingProcess["startTime"]:.2f} seconds')
+
+  def _labelmapGeometry(self, labelVolume):
+    ijkToRas = vtk.vtkMatrix4x4()
+    labelVolume.GetIJKToRASMatrix(ijkToRas)
+    return slicer.vtkSegmentationConverter.SerializeImageGeometry(ijkToRas, labelVolume.GetImageData())
+
+  def _previousAirwaySegmentId(self, outputSegmentation, labelmapGeometry):
+    """
+    Get the ID of the airway segment if the output segmentation contains only the result of a previous run
+    that was computed with the same labelmap geometry, None otherwise.
+    """
+    segmentation = outputSegmentation.GetSegmentation()
+    segmentId = outputSegmentation.GetAttribute("AirwaySegmentation.SegmentID")
+    if (not segmentId or segmentation.GetNumberOfSegments() != 1 or segmentation.GetNthSegmentID(0) != segmentId
+      or outputSegmentation.GetAttribute("AirwaySegmentation.LabelmapGeometry") != labelmapGeometry):
+      return None
+    return segmentId
+
+  def _getTemporaryLabelVolume(self):
+    """
+    Get the hidden labelmap volume node that stores the segmentation result before it is imported
+    into the output segmentation. The node is created once and reused to avoid adding and removing
+    nodes (and display nodes) in the scene at each run. If it is used by another processing in progress
+    then a new node is created for this run, which is removed when the run is finished.
+    """
+    if self._tmpLabel is None or not slicer.mrmlScene.IsNodePresent(self._tmpLabel):
+      self._tmpLabel = self._createTemporaryLabelVolume()
+    if any(pendingProcess["labelVolume"] == self._tmpLabel for pendingProcess in self._pendingProcesses.values()):
+      return self._createTemporaryLabelVolume()
+    return self._tmpLabel
+
+  def _createTemporaryLabelVolume(self):
+    labelVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", "AirwaySegmentationTemporaryLabel")
+    labelVolume.SetHideFromEditors(True)
+    labelVolume.SetSaveWithScene(False)
+    labelVolume.CreateDefaultDisplayNodes()
+    labelVolume.GetDisplayNode().SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileGenericAnatomyColors.txt')
+    return labelVolume
+
+  def _releaseTemporaryLabelVolume(self, labelVolume):
+    if not slicer.mrmlScene.IsNodePresent(labelVolume):
+      return
+    if labelVolume == self._tmpLabel:
+      # Keep the node for the next run, but release the voxel data
+      labelVolume.SetAndObserveImageData(None)
+    else:
+      slicer.mrmlScene.RemoveNode(labelVolume)
+
+  def _getInt16InputVolume(self, inputVolume):
+    """
+    Get a volume with int16 voxel type that the CLI reads without conversion.
+    Volumes of other voxel types (e.g., float) are converted only once and the result is reused
+    until the input volume is modified.
+    """
+    imageData = inputVolume.GetImageData()
+    if imageData.GetScalarType() == vtk.VTK_SHORT:
+      return inputVolume
+
+    cacheKey = (inputVolume.GetID(), inputVolume.GetMTime(), imageData.GetMTime())
+    if (self._int16InputVolume and slicer.mrmlScene.IsNodePresent(self._int16InputVolume)
+      and self._int16InputVolumeKey == cacheKey):
+      return self._int16InputVolume
+
+    self._removeInt16InputVolume()
+
+    import numpy as np
+    volumeArray = slicer.util.arrayFromVolume(inputVolume)
+    # Same truncation as the implicit conversion of the CLI's image reader
+    int16Array = np.clip(volumeArray, -32768, 32767).astype(np.int16)
+    int16Volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + " int16")
+    int16Volume.SetHideFromEditors(True)
+    int16Volume.SetSaveWithScene(False)
+    int16Volume.CopyOrientation(inputVolume)
+    int16Volume.SetAndObserveTransformNodeID(inputVolume.GetTransformNodeID())
+    slicer.util.updateVolumeFromArray(int16Volume, int16Array)
+
+    self._int16InputVolume = int16Volume
+    self._int16InputVolumeKey = cacheKey
+    # The copy can be as large as the input volume, do not keep it after the input volume is removed
+    if not self.hasObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self._onNodeRemoved):
+      self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self._onNodeRemoved)
+    return int16Volume
+
+  def _removeInt16InputVolume(self, int16Volume=None):
+    """
+    Remove the cached int16 volume. If int16Volume is specified then it is only removed if it is still the cached volume.
+    """
+    if int16Volume and int16Volume != self._int16InputVolume:
+      return
+    if self._int16InputVolume and slicer.mrmlScene.IsNodePresent(self._int16InputVolume):
+      slicer.mrmlScene.RemoveNode(self._int16InputVolume)
+    self._int16InputVolume = None
+    self._int16InputVolumeKey = None
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def _onNodeRemoved(self, caller, event, removedNode):
+    if not self._int16InputVolumeKey or removedNode.GetID() != self._int16InputVolumeKey[0]:
+      return
+    self.removeObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self._onNodeRemoved)
+    # Remove the copy after the scene has completed the removal of the input volume
+    int16Volume = self._int16InputVolume
+    qt.QTimer.singleShot(0, lambda: self._removeInt16InputVolume(int16Volume))
+
+  def seedIJKFromMarkup(self, inputVolume, inputSeed):
+    """
+    Get voxel coordinates of the first control point of the seed markup in the input volume.
+    """
+    seedWorld = [0.0, 0.0, 0.0]
+    inputSeed.GetNthControlPointPositionWorld(0, seedWorld)
+    # The volume may be transformed, so first get the point position in the volume's RAS coordinate system
+    transformWorldToVolumeRas = vtk.vtkGeneralTransform()
+    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(None, inputVolume.GetParentTransformNode(), transformWorldToVolumeRas)
+    seedVolumeRas = transformWorldToVolumeRas.TransformPoint(seedWorld)
+    volumeRasToIjk = vtk.vtkMatrix4x4()
+    inputVolume.GetRASToIJKMatrix(volumeRasToIjk)
+    seedIJK = volumeRasToIjk.MultiplyPoint(list(seedVolumeRas) + [1.0])[:3]
+    return [int(round(c)) for c in seedIJK]
+
+  def warmUp(self):
+    """
+    Load and initialize the fallback region growing if the CLI module is not available,
+    so that this time is not added to the first processing.
+    """
+    if hasattr(slicer.modules, "airwaysegmentationcli"):
+      return
+    import numpy as np
+    self._growFallback(np.zeros((4,4,4), np.int16), (2,2,2), -1000.0, 0.0, 1)
+
+  def _growFallback(self, volumeArray, seedIJK, thMin, thMax, labelValue):
+    """
+    Segment voxels connected to the seed with intensity between thMin and thMax.
+    This simple region growing is only used when the CLI module is not available.
+    :param volumeArray: voxel array of the input volume (KJI indexing)
+    :param seedIJK: seed point voxel coordinates
+    :return: voxel array containing labelValue in the segmented region and 0 elsewhere
+    """
+    import SimpleITK as sitk
+    dims = volumeArray.shape[::-1]
+    if not all(0 <= seedIJK[i] < dims[i] for i in range(3)):
+      raise ValueError("Seed point is outside the input volume")
+    image = sitk.GetImageFromArray(volumeArray)
+    region = sitk.ConnectedThreshold(image, seedList=[tuple(seedIJK)], lower=thMin, upper=thMax, replaceValue=labelValue)
+    return sitk.GetArrayFromImage(region)
 
   def convolutionKernelFromVolumeNode(self, inputVolume):
     convolutionKernel = None
     instUIDs = inputVolume.GetAttribute('DICOM.instanceUIDs')
     if instUIDs:
-      fileName = slicer.dicomDatabase.fileForInstance(instUIDs.split()[0])
+      instUID = instUIDs.split()[0]
+      if instUID in self._kernelCache:
+        return self._kernelCache[instUID]
+      fileName = slicer.dicomDatabase.fileForInstance(instUID)
       convolutionKernel = slicer.dicomDatabase.fileValue(fileName,'0018,1210')
+      self._kernelCache[instUID] = convolutionKernel
     return convolutionKernel
 
   def show3D(self, segmentationNode):
     """
-    Create and show airway in 3D
+    Create and show airway in 3D.
+    Creating the closed surface of a large airway tree takes a long time, therefore if no 3D view is visible
+    then it is postponed until a 3D view is shown (by switching the layout, restoring a maximized view, etc.).
     """
 
+    # Only the most recent segmentation is shown
+    self._cancelPending3D()
+
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager and not self._isThreeDViewVisible():
+      self._pending3DSegmentation = segmentationNode
+      # A layout switch may also create the 3D widget
+      layoutManager.layoutChanged.connect(self._onThreeDViewMaybeShown)
+      self._observeThreeDWidgetShow()
+      return
+
+    self._render3D(segmentationNode)
+
+  def _isThreeDViewVisible(self):
+    layoutManager = slicer.app.layoutManager()
+    return layoutManager.threeDViewCount > 0 and layoutManager.threeDWidget(0).isVisible()
+
+  def _observeThreeDWidgetShow(self):
+    layoutManager = slicer.app.layoutManager()
+    if self._threeDWidgetShowEventFilter or layoutManager.threeDViewCount == 0:
+      return
+    self._threeDWidget = layoutManager.threeDWidget(0)
+    self._threeDWidgetShowEventFilter = _WidgetShowEventFilter(self._onThreeDViewMaybeShown)
+    self._threeDWidget.installEventFilter(self._threeDWidgetShowEventFilter)
+
+  def _onThreeDViewMaybeShown(self, *args):
+    # Check visibility when the layout or the widget is completely updated
+    qt.QTimer.singleShot(0, self._renderPending3D)
+
+  def _renderPending3D(self):
+    if not self._pending3DSegmentation:
+      return
+    if not self._isThreeDViewVisible():
+      self._observeThreeDWidgetShow()
+      return
+    segmentationNode = self._pending3DSegmentation
+    self._cancelPending3D()
+    if slicer.mrmlScene.IsNodePresent(segmentationNode):
+      self._render3D(segmentationNode)
+
+  def _cancelPending3D(self):
+    if not self._pending3DSegmentation:
+      return
+    self._pending3DSegmentation = None
+    slicer.app.layoutManager().layoutChanged.disconnect(self._onThreeDViewMaybeShown)
+    if self._threeDWidgetShowEventFilter:
+      self._threeDWidget.removeEventFilter(self._threeDWidgetShowEventFilter)
+      self._threeDWidget = None
+      self._threeDWidgetShowEventFilter = None
+
+  def _render3D(self, segmentationNode):
     segmentationNode.CreateClosedSurfaceRepresentation()
 
-    lm = slicer.app.layoutManager()
-    threeDView = lm.threeDWidget( 0 ).threeDView()
+    layoutManager = slicer.app.layoutManager()
+    if not layoutManager:
+      return
+    threeDView = layoutManager.threeDWidget( 0 ).threeDView()
     threeDView.resetFocalPoint()
     threeDView.lookFromViewAxis(ctk.ctkAxesWidget().Anterior)
 
-
 #
 # AirwaySegmentationTest
 #
@@ -385,6 +780,12 @@ class AirwaySegmentationTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_AirwaySegmentation1()
+    self.setUp()
+    self.test_AirwaySegmentationRerun()
+    self.setUp()
+    self.test_AirwaySegmentationFallback()
+    self.setUp()
+    self.test_AirwaySegmentationSeedIJK()
 
   def test_AirwaySegmentation1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -427,7 +828,123 @@ class AirwaySegmentationTest(ScriptedLoadableModuleTest):
     expectedsegmentCenter = (-5.5, -5.9, -100.3)
     segmentId = outputSegmentationNode.GetSegmentation().GetNthSegmentID(0)
     segmentCenter = outputSegmentationNode.GetSegmentCenter(segmentId)
+    self.assertTrue(all(abs(a-b) <= 5.0 for a, b in zip(segmentCenter, expectedsegmentCenter)))
+
+    self.delayDisplay('Test passed')
+
+  def test_AirwaySegmentationRerun(self):
+    """ Test that computing the segmentation again updates the airway segment of the previous run.
+    """
+
+    self.delayDisplay("Starting the re-run test")
+
+    import SampleData
+    inputVolumeNode = SampleData.downloadSample('CTChest')
+
+    inputSeedNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+    inputSeedNode.AddControlPointWorld([-9.8, 3.4, -40.9])
+
+    # An unrelated segment in the output is replaced by the airway segment
+    outputSegmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+    lungSegmentId = outputSegmentationNode.GetSegmentation().AddEmptySegment("Lung")
+
+    logic = AirwaySegmentationLogic()
+    expectedsegmentCenter = (-5.5, -5.9, -100.3)
+
+    self.delayDisplay('Compute the segmentation')
+    logic.process(inputVolumeNode, inputSeedNode, outputSegmentationNode)
+    self.assertEqual(outputSegmentationNode.GetSegmentation().GetNumberOfSegments(), 1)
+    segmentId = outputSegmentationNode.GetSegmentation().GetNthSegmentID(0)
+    self.assertNotEqual(segmentId, lungSegmentId)
+
+    import numpy as np
+    segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(outputSegmentationNode, segmentId, inputVolumeNode)
+    numberOfSegmentVoxels = np.count_nonzero(segmentArray)
+    self.assertGreater(numberOfSegmentVoxels, 0)
+
+    # Erase the upper half of the segment, so that the test can detect if the voxels are replaced by the re-run
+    segmentArray[segmentArray.shape[0]//2:] = 0
+    slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, outputSegmentationNode, segmentId, inputVolumeNode)
+    self.assertLess(np.count_nonzero(slicer.util.arrayFromSegmentBinaryLabelmap(outputSegmentationNode, segmentId, inputVolumeNode)),
+      numberOfSegmentVoxels)
+
+    self.delayDisplay('Compute the segmentation again')
+    logic.process(inputVolumeNode, inputSeedNode, outputSegmentationNode)
+    self.assertEqual(outputSegmentationNode.GetSegmentation().GetNumberOfSegments(), 1)
+    self.assertEqual(outputSegmentationNode.GetSegmentation().GetNthSegmentID(0), segmentId)
+    # The re-run computes the same segmentation, which fully replaces the partially erased segment
+    segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(outputSegmentationNode, segmentId, inputVolumeNode)
+    self.assertEqual(np.count_nonzero(segmentArray), numberOfSegmentVoxels)
+    segmentCenter = outputSegmentationNode.GetSegmentCenter(segmentId)
+    self.assertTrue(all(abs(a-b) <= 5.0 for a, b in zip(segmentCenter, expectedsegmentCenter)))
+
+    self.delayDisplay('Test passed')
+
+  def test_AirwaySegmentationFallback(self):
+    """ Test the region growing that is used when the CLI module is not available.
+    """
+
+    self.delayDisplay("Starting the fallback region growing test")
+
     import numpy as np
-    self.assertTrue(np.allclose(segmentCenter, expectedsegmentCenter, atol=5.0))
+    logic = AirwaySegmentationLogic()
+    labelValue = 170
+
+    # Voxel array uses KJI indexing. A connected air region in the middle and a separate air region in a corner.
+    volumeArray = np.zeros((5,6,7), np.int16)
+    volumeArray[2, 1:5, 3] = -1000
+    volumeArray[2, 4, 4:7] = -950
+    volumeArray[0, 0, 0] = -1000
+    expectedLabelArray = np.zeros(volumeArray.shape, np.int16)
+    expectedLabelArray[2, 1:5, 3] = labelValue
+    expectedLabelArray[2, 4, 4:7] = labelValue
+
+    # Seed is in IJK order
+    labelArray = logic._growFallback(volumeArray, [3, 1, 2], float(volumeArray.min()), -900.0, labelValue)
+    self.assertTrue(np.array_equal(labelArray, expectedLabelArray))
+
+    # A lower upper threshold excludes part of the region
+    labelArray = logic._growFallback(volumeArray, [3, 1, 2], float(volumeArray.min()), -960.0, labelValue)
+    self.assertEqual(np.count_nonzero(labelArray), 4)
+
+    # Seed point outside the volume
+    with self.assertRaises(ValueError):
+      logic._growFallback(volumeArray, [7, 1, 2], float(volumeArray.min()), -900.0, labelValue)
+    with self.assertRaises(ValueError):
+      logic._growFallback(volumeArray, [3, -1, 2], float(volumeArray.min()), -900.0, labelValue)
+
+    self.delayDisplay('Test passed')
+
+  def test_AirwaySegmentationSeedIJK(self):
+    """ Test that the seed point is converted to voxel coordinates of a transformed volume.
+    """
+
+    self.delayDisplay("Starting the seed voxel coordinates test")
+
+    import numpy as np
+    inputVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    slicer.util.updateVolumeFromArray(inputVolumeNode, np.zeros((10,10,10), np.int16))
+    inputVolumeNode.SetSpacing(2.0, 1.5, 3.0)
+    inputVolumeNode.SetOrigin(10.0, 20.0, 30.0)
+
+    # Rotate around the S axis and translate the volume
+    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    transform = vtk.vtkTransform()
+    transform.Translate(5.0, -3.0, 7.0)
+    transform.RotateZ(30.0)
+    transformNode.SetMatrixTransformToParent(transform.GetMatrix())
+    inputVolumeNode.SetAndObserveTransformNodeID(transformNode.GetID())
+
+    # Place the seed at the world position of a known voxel
+    expectedSeedIJK = [3, 4, 5]
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolumeNode.GetIJKToRASMatrix(ijkToRas)
+    seedVolumeRas = ijkToRas.MultiplyPoint(expectedSeedIJK + [1])[:3]
+    seedWorld = transform.TransformPoint(seedVolumeRas)
+    inputSeedNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+    inputSeedNode.AddControlPointWorld(list(seedWorld))
+
+    logic = AirwaySegmentationLogic()
+    self.assertEqual(logic.seedIJKFromMarkup(inputVolumeNode, inputSeedNode), expectedSeedIJK)
 
     self.delayDisplay('Test passed')
@@ -13,13 +13,11 @@
 ==========================================================================*/
 
 #include "itkMaskNegatedImageFilter.h"
-#include "itkConnectedThresholdImageFilter.h"
 #include "itkRegionOfInterestImageFilter.h"
 #include "itkPasteImageFilter.h"
 #include "itkBinaryImageToShapeLabelMapFilter.h"
 #include "itkSubtractImageFilter.h"
 #include "itkImage.h"
-#include "itkCastImageFilter.h"
 #include "itkImageFileReader.h"
 #include "itkImageFileWriter.h"
 #include "itkPluginFilterWatcher.h"
@@ -32,10 +30,16 @@
 #include "itkVotingBinaryIterativeHoleFillingImageFilter.h"
 #include "itkFlipImageFilter.h"
 #include "itkImageSliceIteratorWithIndex.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
 #include "itkImageDuplicator.h"
+#include "itkBinaryThresholdImageFilter.h"
+#include "itkMultiThreaderBase.h"
 
 #include "itkGrayscaleFillholeImageFilter.h"
 
+#include <algorithm>
+#include <exception>
+#include <thread>
 #include <vector>
 
 #include "AirwaySegmentationCLICLP.h"
@@ -49,64 +53,225 @@ typedef unsigned short  OutputPixelType;
 typedef itk::Image<InputPixelType, DIM>  InputImageType;
 typedef itk::Image<OutputPixelType, DIM> OutputImageType;
 
+/** CLASS COMPUTING THE CONNECTION LEVEL OF EACH VOXEL TO A SEED POINT */
+/*  The region that ConnectedThresholdImageFilter grows from a seed with an upper threshold T (and no lower
+    threshold) contains exactly the voxels whose connection level is <= T. The connection level of a voxel
+    is the lowest possible value of the highest intensity along a face-connected path from the seed to the
+    voxel. All connection levels are computed by a single priority flood from the seed, after which the
+    number of voxels in the region grown with any upper threshold is read from a cumulative histogram,
+    instead of repeating the region growing for every candidate threshold. The region itself is obtained
+    by thresholding the connection levels, which is a data-parallel (multi-threaded) operation.
+*/
+class SeedConnectionLevels
+{
+public:
+    SeedConnectionLevels( InputImageType::Pointer image, InputPixelType maximumLevel )
+        : m_Image( image ),
+          m_MaximumLevel( maximumLevel ),
+          m_Modified( true )
+    {
+        m_Seed.Fill( 0 );
+    }
+
+    void SetSeed( const InputImageType::IndexType & seed )
+    {
+        if( seed != m_Seed )
+        {
+            m_Seed     = seed;
+            m_Modified = true;
+        }
+    }
+
+    /** Number of voxels in the region grown from the seed with the specified upper threshold */
+    double GetNumberOfVoxels( InputPixelType upperThreshold )
+    {
+        if( upperThreshold > m_MaximumLevel )
+        {
+            // Levels above the maximum are not computed, flood again with some headroom
+            m_MaximumLevel = std::min<int>( int(upperThreshold) + 50, itk::NumericTraits<InputPixelType>::max() );
+            m_Modified     = true;
+        }
+        if( m_Modified )
+        {
+            this->Compute();
+        }
+        return double( m_CumulativeCounts[ upperThreshold - itk::NumericTraits<InputPixelType>::NonpositiveMin() ] );
+    }
+
+    /** Region grown from the seed with the specified upper threshold */
+    OutputImageType::Pointer GetRegion( InputPixelType upperThreshold, OutputPixelType labelValue )
+    {
+        // Make sure that connection levels are computed up to the threshold
+        this->GetNumberOfVoxels( upperThreshold );
+
+        typedef itk::BinaryThresholdImageFilter< InputImageType, OutputImageType > ThresholdFilterType;
+        ThresholdFilterType::Pointer thresholdFilter = ThresholdFilterType::New();
+
+        thresholdFilter->SetInput( m_Levels );
+        thresholdFilter->SetLowerThreshold( itk::NumericTraits<InputPixelType>::NonpositiveMin() );
+        thresholdFilter->SetUpperThreshold( upperThreshold );
+        thresholdFilter->SetInsideValue( labelValue );
+        thresholdFilter->SetOutsideValue( 0 );
+        thresholdFilter->Update();
+
+        return thresholdFilter->GetOutput();
+    }
+
+private:
+    /** Lower the connection level of the neighbors of a voxel that is reached at the specified level */
+    inline void VisitNeighbors( const InputPixelType * input, InputPixelType * levels, InputPixelType level,
+                                const ::size_t * neighbors, unsigned int numberOfNeighbors,
+                                std::vector< std::vector< ::size_t > > & buckets )
+    {
+        for( unsigned int i = 0; i < numberOfNeighbors; ++i )
+        {
+            InputPixelType neighborLevel = std::max( level, input[neighbors[i]] );
+            if( neighborLevel <= m_MaximumLevel && neighborLevel < levels[neighbors[i]] )
+            {
+                levels[neighbors[i]] = neighborLevel;
+                buckets[ neighborLevel - itk::NumericTraits<InputPixelType>::NonpositiveMin() ].push_back( neighbors[i] );
+            }
+        }
+    }
+
+    void Compute()
+    {
+        const InputPixelType minimumLevel = itk::NumericTraits<InputPixelType>::NonpositiveMin();
+        const InputPixelType unreached    = itk::NumericTraits<InputPixelType>::max();
+
+        m_Modified = false;
+        m_CumulativeCounts.assign( int(m_MaximumLevel) - minimumLevel + 1, 0 );
+
+        InputImageType::RegionType region = m_Image->GetBufferedRegion();
+        if( !m_Levels )
+        {
+            m_Levels = InputImageType::New();
+            m_Levels->CopyInformation( m_Image );
+            m_Levels->SetRegions( region );
+            m_Levels->Allocate();
+        }
+        m_Levels->FillBuffer( unreached );
+
+        if( !region.IsInside( m_Seed ) )
+        {
+            return;
+        }
+
+        const InputPixelType * input = m_Image->GetBufferPointer();
+        const ::size_t sizeX  = region.GetSize(0);
+        const ::size_t sizeY  = region.GetSize(1);
+        const ::size_t sizeZ  = region.GetSize(2);
+        const ::size_t sliceSize = sizeX * sizeY;
+
+        InputPixelType * levels = m_Levels->GetBufferPointer();
+
+        // Levels are integers in a small range, so instead of a binary heap the flood uses a bucket queue:
+        // one list of voxel offsets per level, processed in increasing level order. Each list is a stack,
+        // push and pop are O(1) and a voxel is never queued with a level lower than the current one.
+        const ::size_t numberOfBuckets = m_CumulativeCounts.size();
+        std::vector< std::vector< ::size_t > > buckets( numberOfBuckets );
+
+        ::size_t seedOffset = m_Image->ComputeOffset( m_Seed );
+        if( input[seedOffset] > m_MaximumLevel )
+        {
+            return;
+        }
+        levels[seedOffset] = input[seedOffset];
+        buckets[ input[seedOffset] - minimumLevel ].push_back( seedOffset );
+
+        // Offsets of the 6 face neighbors of voxels that are not on the image border
+        const ::size_t neighborOffsets[6] = { ::size_t(-1), 1, ::size_t(0) - sizeX, sizeX, ::size_t(0) - sliceSize, sliceSize };
+        ::size_t neighbors[6];
+        for( ::size_t bucket = input[seedOffset] - minimumLevel; bucket < numberOfBuckets; ++bucket )
+        {
+            const InputPixelType level = InputPixelType( int(bucket) + minimumLevel );
+            std::vector< ::size_t > & queue = buckets[bucket];
+            while( !queue.empty() )
+            {
+                ::size_t offset = queue.back();
+                queue.pop_back();
+                if( level != levels[offset] )
+                {
+                    // A lower level was found for this voxel after it was queued
+                    continue;
+                }
+                m_CumulativeCounts[bucket]++;
+
+                // The image size is only known at run time, so the divisions are not constant-folded:
+                // derive all three indices from two divisions instead of one per index
+                ::size_t z = offset / sliceSize;
+                ::size_t offsetInSlice = offset - z * sliceSize;
+                ::size_t y = offsetInSlice / sizeX;
+                ::size_t x = offsetInSlice - y * sizeX;
+
+                // Almost all voxels are inside the image, where all 6 neighbors exist and a single test replaces
+                // the per-neighbor border checks. The offsets wrap around in unsigned arithmetic as intended.
+                if( x - 1 < sizeX - 2 && y - 1 < sizeY - 2 && z - 1 < sizeZ - 2 )
+                {
+                    for( unsigned int i = 0; i < 6; ++i )
+                    {
+                        neighbors[i] = offset + neighborOffsets[i];
+                    }
+                    this->VisitNeighbors( input, levels, level, neighbors, 6, buckets );
+                    continue;
+                }
+
+                unsigned int numberOfNeighbors = 0;
+                if( x > 0 )         neighbors[numberOfNeighbors++] = offset - 1;
+                if( x + 1 < sizeX ) neighbors[numberOfNeighbors++] = offset + 1;
+                if( y > 0 )         neighbors[numberOfNeighbors++] = offset - sizeX;
+                if( y + 1 < sizeY ) neighbors[numberOfNeighbors++] = offset + sizeX;
+                if( z > 0 )         neighbors[numberOfNeighbors++] = offset - sliceSize;
+                if( z + 1 < sizeZ ) neighbors[numberOfNeighbors++] = offset + sliceSize;
+
+                this->VisitNeighbors( input, levels, level, neighbors, numberOfNeighbors, buckets );
+            }
+            // Release the memory of the processed bucket
+            std::vector< ::size_t >().swap( queue );
+        }
+
+        for( ::size_t i = 1; i < m_CumulativeCounts.size(); ++i )
+        {
+            m_CumulativeCounts[i] += m_CumulativeCounts[i - 1];
+        }
+    }
+
+    InputImageType::Pointer    m_Image;
+    InputImageType::Pointer    m_Levels;
+    InputImageType::IndexType  m_Seed;
+    InputPixelType             m_MaximumLevel;
+    bool                       m_Modified;
+    std::vector<unsigned long> m_CumulativeCounts;
+};
+
+
 /** FUNCTION FOR TRACHEA SEGMENTATION */
 
 OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                                               InputImageType::IndexType indexFiducialSlice,
-                                              std::vector<std::vector<float> > fiducial,
+                                              InputImageType::PointType seedPoint,
                                               int labelColor = 2 )
 {
-    OutputImageType::Pointer trachea 		= OutputImageType::New(); 
-    OutputImageType::Pointer tracheaPrev 	= OutputImageType::New();
-	
-    trachea->SetRegions( VOI->GetRequestedRegion() );                                   
-    trachea->SetBufferedRegion( VOI->GetBufferedRegion() );
-    trachea->SetLargestPossibleRegion( VOI->GetLargestPossibleRegion() );
-    trachea->CopyInformation( VOI );
-    trachea->Allocate();
-  		
     /** TRACHEA SEGMENTATION PIPELINE */
-    typedef itk::ConnectedThresholdImageFilter< InputImageType, InputImageType > ConnectedFilterType; 
-    ConnectedFilterType::Pointer thresholdConnected = ConnectedFilterType::New(); 
-	
-    thresholdConnected->SetInput( VOI );	
-    thresholdConnected->SetReplaceValue( labelColor );    
+    // The trachea is grown from the seed with many different upper thresholds. All of them are obtained
+    // from the connection levels of one flood from the seed, which is only repeated when the seed is moved.
+    // Every grown region is a new image, so previous regions can be kept without duplicating them.
+    SeedConnectionLevels connectionLevels( VOI, -800 );
    	
     // Starting upper threshold value
     InputPixelType UpperThreshold = -900;	                    		   
-
-    thresholdConnected->SetUpper( UpperThreshold );          
 	
-    InputImageType::PointType lpsPoint;
+    // Seed point is in lps
     InputImageType::IndexType index;
-	
-    // Seeds come in ras, convert to lps
-    for( ::size_t i = 0; i < fiducial.size(); ++i )
-    {
-        lpsPoint[0] = fiducial[i][0] * (-VOI->GetDirection()[0][0]);
-        lpsPoint[1] = fiducial[i][1] * (-VOI->GetDirection()[1][1]);
-        lpsPoint[2] = fiducial[i][2] *   VOI->GetDirection()[2][2];
-
-        VOI->TransformPhysicalPointToIndex(lpsPoint, index);
-        thresholdConnected->AddSeed( index );
-    }
+    VOI->TransformPhysicalPointToIndex(seedPoint, index);
+    connectionLevels.SetSeed( index );
 
-    typedef itk::CastImageFilter<InputImageType, OutputImageType> CastingFilterType;  
-    CastingFilterType::Pointer  caster = CastingFilterType::New();		
-	
-    caster->SetInput( thresholdConnected->GetOutput() );  
-    caster->Update();
-    trachea = caster->GetOutput();	
+    OutputImageType::Pointer trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
+    OutputImageType::Pointer tracheaPrev;
 
     /** COMPUTING THE LABEL SIZES */	 	                  
-    OutputImageType::Pointer tracheaAxialCopy = OutputImageType::New(); 
-    OutputImageType::Pointer tracheaCoronalCopy = OutputImageType::New(); 
-
-    typedef itk::ImageDuplicator<OutputImageType> DuplicatorFilterType;
-
-    DuplicatorFilterType::Pointer duplicatorFilter = DuplicatorFilterType::New();
-    duplicatorFilter->SetInputImage(trachea);
-    duplicatorFilter->Update();
+    OutputImageType::Pointer tracheaAxialCopy; 
+    OutputImageType::Pointer tracheaCoronalCopy; 
 
     // Extracting the axial slice containing the trachea fiducial point
     OutputImageType::SizeType  oneAxialSliceSize;
@@ -190,8 +355,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
         axialSlice.SetSize( oneAxialSliceSize );
         axialSlice.SetIndex( indexAxialSlice );
 
-        duplicatorFilter->Update();	
-        tracheaAxialCopy = duplicatorFilter->GetOutput();	
+        tracheaAxialCopy = trachea;	
             
         axialTracheaFilter->SetInput( tracheaAxialCopy );
         axialTracheaFilter->SetRegionOfInterest( axialSlice );
@@ -212,12 +376,8 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                 {
                     UpperThreshold = UpperThreshold - 20;
 
-                    thresholdConnected->SetUpper( UpperThreshold ); 
-                    caster->SetInput( thresholdConnected->GetOutput() ); 
-                    caster->Update();
-                    trachea = caster->GetOutput();
-                    duplicatorFilter->Update();	
-                    tracheaAxialCopy = duplicatorFilter->GetOutput();	
+                    trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
+                    tracheaAxialCopy = trachea;	
                     axialTracheaFilter->SetInput( tracheaAxialCopy );
                     axialTracheaFilter->SetRegionOfInterest( axialSlice );
                     axialTracheaFilter->Update();
@@ -236,8 +396,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                 coronalSlice.SetIndex( indexCoronalSlice );
                 coronalSlice.SetSize( oneCoronalSliceSize );
 
-                duplicatorFilter->Update();	
-                tracheaCoronalCopy = duplicatorFilter->GetOutput();	
+                tracheaCoronalCopy = trachea;	
 
                 coronalTracheaFilter->SetInput( tracheaCoronalCopy );
                 coronalTracheaFilter->SetRegionOfInterest( coronalSlice );
@@ -256,12 +415,8 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                     {
                         UpperThreshold = UpperThreshold - 20;
 
-                        thresholdConnected->SetUpper( UpperThreshold ); 
-                        caster->SetInput( thresholdConnected->GetOutput() );  
-                        caster->Update();
-                        trachea = caster->GetOutput();
-                        duplicatorFilter->Update();	
-                        tracheaCoronalCopy = duplicatorFilter->GetOutput();	
+                        trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
+                        tracheaCoronalCopy = trachea;	
                         coronalTracheaFilter->SetInput( tracheaCoronalCopy );
                         coronalTracheaFilter->SetRegionOfInterest( coronalSlice );
                         coronalTracheaFilter->Update();
@@ -309,14 +464,8 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                     indexCoronalSlice[1] = index[1];
                     indexCoronalSlice[2] = index[2] - 3;
 
-                    thresholdConnected->ClearSeeds();
-                    thresholdConnected->AddSeed( index );
-                    thresholdConnected->Update();                
-    
-                    caster->SetInput( thresholdConnected->GetOutput() );
-                    caster->Update();	
-
-                    trachea = caster->GetOutput();	
+                    connectionLevels.SetSeed( index );
+                    trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
                     isMinor = 1;
                 }
                 counter++;   
@@ -328,13 +477,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                 {
                     UpperThreshold = UpperThreshold + 50;
 
-                    thresholdConnected->SetUpper( UpperThreshold ); 
-                    thresholdConnected->Update();                
-    
-                    caster->SetInput( thresholdConnected->GetOutput() );
-                    caster->Update();
-
-                    trachea = caster->GetOutput();
+                    trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
                 }
                 else
                 {
@@ -348,13 +491,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                 {
                     UpperThreshold = UpperThreshold + 1;
 
-                    thresholdConnected->SetUpper( UpperThreshold ); 
-                    thresholdConnected->Update();
-
-                    caster->SetInput( thresholdConnected->GetOutput() ); 
-                    caster->Update();
-
-                    trachea = caster->GetOutput();	
+                    trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
                 }
                 else
                 {
@@ -366,8 +503,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
             axialSlice.SetSize( oneAxialSliceSize );
             axialSlice.SetIndex( indexAxialSlice );
 
-            duplicatorFilter->Update();	
-            tracheaAxialCopy = duplicatorFilter->GetOutput();	
+            tracheaAxialCopy = trachea;	
             
             axialTracheaFilter->SetInput( tracheaAxialCopy );
             axialTracheaFilter->SetRegionOfInterest( axialSlice );
@@ -379,8 +515,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
             coronalSlice.SetIndex( indexCoronalSlice );
             coronalSlice.SetSize( oneCoronalSliceSize );
 
-            duplicatorFilter->Update();	
-            tracheaCoronalCopy = duplicatorFilter->GetOutput();	
+            tracheaCoronalCopy = trachea;	
 
             coronalTracheaFilter->SetInput( tracheaCoronalCopy );
             coronalTracheaFilter->SetRegionOfInterest( coronalSlice );
@@ -395,9 +530,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
     }
     while( !firstCheck && UpperThreshold > -1100 );
     
-    duplicatorFilter->SetInputImage(trachea);
-    duplicatorFilter->Update();
-    tracheaPrev = duplicatorFilter->GetOutput();
+    tracheaPrev = trachea;
         
     /** INCREASING THE THRESHOLD ITERATIVELY UNTIL LEAKAGE OCCURS */
     typedef itk::SubtractImageFilter< OutputImageType,OutputImageType,OutputImageType > SubtractLabelImageType; 
@@ -432,11 +565,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                     if( decrease )
                     {
                         UpperThreshold = UpperThreshold - 10;
-                        thresholdConnected->SetUpper( UpperThreshold ); 
-                        thresholdConnected->Update();
-                        caster->SetInput( thresholdConnected->GetOutput() );
-                        caster->Update();
-                        trachea = caster->GetOutput();
+                        trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
                     }
                     check = 1;
                     i = labelSizeFilter->GetOutput()->GetNumberOfLabelObjects() - 1;
@@ -447,9 +576,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
         {
             if( UpperThreshold < -800 )
             {
-                duplicatorFilter->SetInputImage(trachea);
-                duplicatorFilter->Update();
-                tracheaPrev = duplicatorFilter->GetOutput();
+                tracheaPrev = trachea;
                 if( !decrease )
                 {
                     UpperThreshold = UpperThreshold + 50;
@@ -458,11 +585,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
                 {
                     UpperThreshold = UpperThreshold + 10;
                 }
-                thresholdConnected->SetUpper( UpperThreshold ); 
-                thresholdConnected->Update();
-                caster->SetInput( thresholdConnected->GetOutput() );
-                caster->Update();
-                trachea = caster->GetOutput();	
+                trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
             }
             else
             {
@@ -480,10 +603,7 @@ OutputImageType::Pointer TracheaSegmentation( InputImageType::Pointer VOI,
         {
             UpperThreshold = UpperThreshold - 10;
 
-            thresholdConnected->SetUpper( UpperThreshold ); 
-            caster->SetInput( thresholdConnected->GetOutput() );  
-            trachea = caster->GetOutput();			
-            caster->Update();
+            trachea = connectionLevels.GetRegion( UpperThreshold, labelColor );
 
             addedLabel->SetInput1( trachea );
             addedLabel->SetInput2( tracheaPrev );
@@ -748,36 +868,22 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
 
     /** SEGMENTATION PIPELINE */
 
-    typedef itk::ConnectedThresholdImageFilter< InputImageType, InputImageType > ConnectedFilterType; 
-    ConnectedFilterType::Pointer thresholdConnected = ConnectedFilterType::New();
-
-    thresholdConnected->SetInput( VOI );			  
-    thresholdConnected->SetReplaceValue( labelColor ); 
+    // The number of voxels and the region grown with a candidate threshold are computed from the
+    // connection levels, without running the region growing for each threshold.
+    // The threshold search below does not go above -780 HU in practice.
+    SeedConnectionLevels connectionLevels( VOI, -780 );
 
     InputPixelType UpperThreshold = -930;	
 
-    thresholdConnected->SetUpper( UpperThreshold ); 
-    thresholdConnected->AddSeed( index );
-
-    typedef itk::CastImageFilter<InputImageType, OutputImageType> CastingFilterType;
-    CastingFilterType::Pointer caster = CastingFilterType::New();	
-
-    caster->SetInput( thresholdConnected->GetOutput() );  
-    caster->Update();      
-
-    // The number of voxels resulting from the first segmentation are counted
-    typedef itk::StatisticsImageFilter< OutputImageType > StatisticsImageFilterType;
-    StatisticsImageFilterType::Pointer StatisticsFilter = StatisticsImageFilterType::New();
-
-    StatisticsFilter->SetInput(caster->GetOutput());
-    StatisticsFilter->Update();
-    n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+    connectionLevels.SetSeed( index );
+    n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
 
     // If the starting threshold gives an empty segmentation, neighbours are checked
     InputImageType::SizeType radius,regionSize;
     InputImageType::IndexType regionIndex;
     InputImageType::RegionType region;	                                                        
     
+    bool emptySegmentation = 0;
     if( n_voxels == 0 )
     {
         bool isMinor = 0;
@@ -798,14 +904,7 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
             if( iterator.GetPixel(counter) < UpperThreshold )
             {
                 index = iterator.GetIndex( counter );				
-			
-                thresholdConnected->ClearSeeds();
-                thresholdConnected->AddSeed( index );
-                thresholdConnected->Update();
-				
-                caster->SetInput( thresholdConnected->GetOutput() );   	
-                caster->Update();	
-			
+                connectionLevels.SetSeed( index );
                 isMinor = 1;
             }
             counter++;  
@@ -813,29 +912,25 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
         if ( !isMinor )
         {
             std::cout<<"Please move the seed point in a different position."<<std::endl;
-            return caster->GetOutput();
+            emptySegmentation = 1;
+        }
+        else
+        {
+            n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
         }
-
-        StatisticsFilter->SetInput(caster->GetOutput());
-        StatisticsFilter->Update();
-        n_voxels = ( StatisticsFilter->GetSum() / labelColor );
     }
 
     // If the number of voxels resulting form the segmentation is too high the threshold is iteratively decreased
-    if( n_voxels > n_voxels_max )
+    if( emptySegmentation )
+    {
+        // Keep the starting threshold and seed
+    }
+    else if( n_voxels > n_voxels_max )
     {		
         while( n_voxels > n_voxels_max )
         {
             UpperThreshold = UpperThreshold - 10;
-            
-            thresholdConnected->SetUpper( UpperThreshold );
-            thresholdConnected->Update();			
-            caster->SetInput( thresholdConnected->GetOutput() );  
-            caster->Update();
-					
-            StatisticsFilter->SetInput(caster->GetOutput());
-            StatisticsFilter->Update();			
-            n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+            n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
 
             if( n_voxels < 5000 )
             {
@@ -858,17 +953,8 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
                     if( iterator.GetPixel(counter) < UpperThreshold )
                     {
                         index = iterator.GetIndex( counter );				
-							
-                        thresholdConnected->ClearSeeds();
-                        thresholdConnected->AddSeed( index );
-                        thresholdConnected->Update(); 
-
-                        caster->SetInput( thresholdConnected->GetOutput() );   	
-                        caster->Update();
-							
-                        StatisticsFilter->SetInput(caster->GetOutput());
-                        StatisticsFilter->Update();
-                        n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+                        connectionLevels.SetSeed( index );
+                        n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
 							
                         if( n_voxels > 4000 )
                         {
@@ -888,15 +974,7 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
                 n_voxels_prev = n_voxels;
             }
             UpperThreshold = UpperThreshold + 1;
-            thresholdConnected->SetUpper( UpperThreshold );
-            thresholdConnected->Update();
-            caster->SetInput( thresholdConnected->GetOutput() );  
-            caster->Update();
-				
-            StatisticsFilter->SetInput(caster->GetOutput());
-            StatisticsFilter->Update();	
-				
-            n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+            n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
             					
             if( n_voxels < 5000 )
             {
@@ -919,17 +997,8 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
                     if( iterator.GetPixel(counter) < UpperThreshold )
                     {
                         index = iterator.GetIndex( counter );				
-						
-                        thresholdConnected->ClearSeeds();
-                        thresholdConnected->AddSeed( index );
-                        thresholdConnected->Update(); 
-
-                        caster->SetInput( thresholdConnected->GetOutput() );   	
-                        caster->Update();
-				
-                        StatisticsFilter->SetInput(caster->GetOutput());
-                        StatisticsFilter->Update();
-                        n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+                        connectionLevels.SetSeed( index );
+                        n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
 
                         if(n_voxels > 4000)
                         {
@@ -946,20 +1015,11 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
         }
 
         UpperThreshold = UpperThreshold - 1;
-        thresholdConnected->SetUpper( UpperThreshold );	
-        caster->SetInput( thresholdConnected->GetOutput() );  
-        caster->Update();
-
-        StatisticsFilter->SetInput(caster->GetOutput());
-        StatisticsFilter->Update();			
-        n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+        n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
 
         if( n_voxels < 4000 )
         {
             UpperThreshold = UpperThreshold + 1;
-            thresholdConnected->SetUpper( UpperThreshold );
-            caster->SetInput( thresholdConnected->GetOutput() );  
-            caster->Update();
         }
     }
     else      // The threshold is iteratively increased until leakage occurs
@@ -970,80 +1030,44 @@ OutputImageType::Pointer RightLeftSegmentation( InputImageType::Pointer VOI,
             while( n_voxels < 5000 )
             { 
                 UpperThreshold = UpperThreshold + 1;
-                thresholdConnected->SetUpper( UpperThreshold );
-        
-                caster->SetInput( thresholdConnected->GetOutput() );  
-                caster->Update();
-    			
-                StatisticsFilter->SetInput(caster->GetOutput());
-                StatisticsFilter->Update();	
-    			
-                n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+                n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
             }
         }
         do{	
             UpperThreshold = UpperThreshold + 20;
 
             n_voxels_prev = n_voxels;	
-    			
-            thresholdConnected->SetUpper( UpperThreshold );
-    	
-            caster->SetInput( thresholdConnected->GetOutput() );  
-            caster->Update();
-    			
-            StatisticsFilter->SetInput(caster->GetOutput());
-            StatisticsFilter->Update();
-    
-            n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+            n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
             g = double( n_voxels/n_voxels_prev );	// double((n_voxels - n_voxels_prev)/n_voxels_prev) according to Gao et al.
         }while( g < g_max && n_voxels < n_voxels_max && UpperThreshold <= -800 );
 		
         UpperThreshold = UpperThreshold - 20;	
-        thresholdConnected->SetUpper( UpperThreshold );
-
-        caster->SetInput( thresholdConnected->GetOutput() );  
-        caster->Update();
-	
-        StatisticsFilter->SetInput(caster->GetOutput());
-        StatisticsFilter->Update();	
-        n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+        n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
 
         do{	
             UpperThreshold = UpperThreshold + 1;
             n_voxels_prev = n_voxels;	
-    			
-            thresholdConnected->SetUpper( UpperThreshold );		
-    	
-            caster->SetInput( thresholdConnected->GetOutput() );  
-            caster->Update();
-    
-            StatisticsFilter->SetInput(caster->GetOutput());
-            StatisticsFilter->Update();
-			
-            n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+            n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
             g = double( n_voxels/n_voxels_prev );	// double((n_voxels - n_voxels_prev)/n_voxels_prev) according to Gao et al.
         }while( g < g_max && n_voxels < n_voxels_max && UpperThreshold <= -800 );
 			
         UpperThreshold = UpperThreshold - 1;
-
-        thresholdConnected->SetUpper( UpperThreshold );	
-        caster->SetInput( thresholdConnected->GetOutput() );  
-        caster->Update();
-    
-        StatisticsFilter->SetInput(caster->GetOutput());
-        StatisticsFilter->Update();			
-        n_voxels = ( StatisticsFilter->GetSum() / labelColor );
+        n_voxels = connectionLevels.GetNumberOfVoxels( UpperThreshold );
     
         if( n_voxels_max > 4000 && n_voxels < 4000 )
         {
             UpperThreshold = UpperThreshold + 1;
-
-            thresholdConnected->SetUpper( UpperThreshold );
-            caster->SetInput( thresholdConnected->GetOutput() );  
-            caster->Update();
         }
     }
-    return caster->GetOutput(); 
+
+    return connectionLevels.GetRegion( UpperThreshold, labelColor );
+}
+
+
+/** FUNCTION WHICH REPORTS THE PROGRESS (0-1) OF THE SEGMENTATION TO THE APPLICATION */
+void ReportProgress( double progress )
+{
+    std::cout << "<filter-progress>" << progress << "</filter-progress>" << std::endl;
 }
 
 
@@ -1073,11 +1097,61 @@ typename ImageType::Pointer Paste( typename ImageType::Pointer sourceImage, type
 }
 
 
+/** FUNCTION WHICH RETURNS THE BOUNDING REGION OF THE VOXELS OF A LABEL (THE WHOLE IMAGE IF THE LABEL IS EMPTY) */
+OutputImageType::RegionType LabelBoundingRegion( OutputImageType::Pointer image, OutputPixelType labelValue )
+{
+    typedef itk::ImageRegionConstIteratorWithIndex< OutputImageType > IteratorType;
+    IteratorType it( image, image->GetLargestPossibleRegion() );
+
+    OutputImageType::IndexType minIndex;
+    OutputImageType::IndexType maxIndex;
+    minIndex.Fill( itk::NumericTraits< OutputImageType::IndexValueType >::max() );
+    maxIndex.Fill( itk::NumericTraits< OutputImageType::IndexValueType >::NonpositiveMin() );
+    bool found = false;
+
+    for( it.GoToBegin(); !it.IsAtEnd(); ++it )
+    {
+        if( it.Get() == labelValue )
+        {
+            const OutputImageType::IndexType & index = it.GetIndex();
+            for( unsigned int i = 0; i < DIM; i++ )
+            {
+                minIndex[i] = std::min( minIndex[i], index[i] );
+                maxIndex[i] = std::max( maxIndex[i], index[i] );
+            }
+            found = true;
+        }
+    }
+
+    if( !found )
+    {
+        return image->GetLargestPossibleRegion();
+    }
+
+    OutputImageType::RegionType region;
+    for( unsigned int i = 0; i < DIM; i++ )
+    {
+        region.SetIndex( i, minIndex[i] );
+        region.SetSize( i, maxIndex[i] - minIndex[i] + 1 );
+    }
+
+    return region;
+}
+
+
 int main( int argc, char *argv[] )
 {
 
     PARSE_ARGS; 	                         
   	
+    // The seeded flood of the region growing is sequential, but thresholding, statistics, masking,
+    // morphological closing and hole filling are multi-threaded and make up a large part of the runtime
+    if( numberOfThreads > 0 )
+    {
+        itk::MultiThreaderBase::SetGlobalMaximumNumberOfThreads( numberOfThreads );
+        itk::MultiThreaderBase::SetGlobalDefaultNumberOfThreads( numberOfThreads );
+    }
+
     typedef itk::ImageFileReader<InputImageType>  ReaderType;				
     ReaderType::Pointer reader = ReaderType::New();     
     
@@ -1094,6 +1168,7 @@ int main( int argc, char *argv[] )
 	std::cerr << e.GetLocation() << std::endl;
 	return EXIT_FAILURE;
     }
+    ReportProgress( 0.05 );
 
     // Take care of not-supine scanned datasets
     bool flipIm = (reader->GetOutput()->GetDirection()[0][0] == -1 && reader->GetOutput()->GetDirection()[1][1] == -1);
@@ -1123,15 +1198,31 @@ int main( int argc, char *argv[] )
     InputImageType::IndexType tracheaFiducial;
     InputImageType::PointType tracheaPoint;
 
-    std::vector< std::vector<float> > tracheaSeedPoint;
-  
     // Finding the trachea seed point 
     int tracheaIndex = 0;
 
-    if( seed.size() == 1 )
+    if( seedIJK.size() == 3 )
+    {
+        // Voxel coordinates are specified in the input image, before flipping
+        InputImageType::SizeType imageSize = reader->GetOutput()->GetLargestPossibleRegion().GetSize();
+        for( unsigned int i = 0; i < DIM; ++i )
+        {
+            if( seedIJK[i] < 0 || seedIJK[i] >= int(imageSize[i]) )
+            {
+                std::cerr << "Seed point is outside the input volume!" << std::endl;
+                return -1;
+            }
+            tracheaFiducial[i] = seedIJK[i];
+        }
+        if( flipIm )
+        {
+            tracheaFiducial[0] = imageSize[0] - 1 - seedIJK[0];
+            tracheaFiducial[1] = imageSize[1] - 1 - seedIJK[1];
+        }
+        reader->GetOutput()->TransformIndexToPhysicalPoint( tracheaFiducial, tracheaPoint );
+    }
+    else if( seed.size() == 1 )
     { 		
-        tracheaSeedPoint.push_back( seed[tracheaIndex] );
-
         // Convert to lps the seed point
         tracheaPoint[0] = seed[tracheaIndex][0] * (-reader->GetOutput()->GetDirection()[0][0]);	
         tracheaPoint[1] = seed[tracheaIndex][1] * (-reader->GetOutput()->GetDirection()[1][1]);
@@ -1142,7 +1233,7 @@ int main( int argc, char *argv[] )
     }
     else
     {
-        if( seed.size() == 0 )
+        if( seed.size() == 0 && seedIJK.size() == 0 )
         {
             std::cerr << "No seeds specified!" << std::endl;
             return -1;
@@ -1202,7 +1293,8 @@ int main( int argc, char *argv[] )
         FiducialSlice[2] = cropSize[2]*0.8;
     }
 
-    trachea = TracheaSegmentation( ROIFilter->GetOutput(), FiducialSlice, tracheaSeedPoint, labelValue );
+    trachea = TracheaSegmentation( ROIFilter->GetOutput(), FiducialSlice, tracheaPoint, labelValue );
+    ReportProgress( 0.2 );
 
     typedef itk::BinaryBallStructuringElement< OutputImageType::PixelType, DIM > StructuringElementType;
   	
@@ -1399,7 +1491,8 @@ int main( int argc, char *argv[] )
     ROIFilter->SetRegionOfInterest( DesiredRegion );					 
     ROIFilter->Update();	
 
-    trachea = TracheaSegmentation( ROIFilter->GetOutput(), FiducialSlice, tracheaSeedPoint, labelValue );
+    trachea = TracheaSegmentation( ROIFilter->GetOutput(), FiducialSlice, tracheaPoint, labelValue );
+    ReportProgress( 0.35 );
 
     OutputImageType::IndexType regionIndex = tracheaCropStart;
    
@@ -1785,25 +1878,9 @@ int main( int argc, char *argv[] )
     maskNegFilter->SetMaskImage( pasteImage );
     maskNegFilter->Update();	
 
-    OutputImageType::Pointer rightLung = OutputImageType::New();
-    std::string reconstructionKernel = reconstructionKernelType.c_str();
-    
-    if( flipIm )
-    {
-        rightLung = RightLeftSegmentation( maskNegFilter->GetOutput(), leftFiducial, reconstructionKernel, numberOfVoxels, labelValue ); 
-    }
-    else
-    {
-        rightLung = RightLeftSegmentation( maskNegFilter->GetOutput(), rightFiducial, reconstructionKernel, numberOfVoxels, labelValue ); 
-    }
-				
-    ShapeLabelType::Pointer rightLabelConverter = ShapeLabelType::New();
-        
-    rightLabelConverter->SetInput( rightLung );
-    rightLabelConverter->SetInputForegroundValue( labelValue );
-    rightLabelConverter->Update();
-		
-    labelMap = rightLabelConverter->GetOutput();        
+    // The masked image must not change when the mask filter is reused for the left airways
+    InputImageType::Pointer rightMaskedImage = maskNegFilter->GetOutput();
+    rightMaskedImage->DisconnectPipeline();
 
     /** LEFT AIRWAY SEGMENTATION */
     OutputImageType::Pointer leftHalfTrachea = OutputImageType::New();
@@ -1995,17 +2072,59 @@ int main( int argc, char *argv[] )
     maskNegFilter->SetMaskImage( pasteImage );
     maskNegFilter->Update();
 
-    OutputImageType::Pointer leftLung = OutputImageType::New();
-	
-    if( flipIm )
+    InputImageType::Pointer leftMaskedImage = maskNegFilter->GetOutput();
+    leftMaskedImage->DisconnectPipeline();
+
+    /** RIGHT AND LEFT AIRWAYS REGION GROWING */
+    // The right and left airways are grown in separate masked images, so the two segmentations are independent
+    // and run at the same time. The left airways are segmented in a separate thread instead of an ITK thread pool
+    // task, because the filters of both segmentations use the thread pool and wait for its tasks to complete.
+    OutputImageType::Pointer rightLung;
+    OutputImageType::Pointer leftLung;
+    std::string reconstructionKernel = reconstructionKernelType.c_str();
+    std::exception_ptr rightException;
+    std::exception_ptr leftException;
+
+    std::thread leftThread( [&]()
     {
-        leftLung = RightLeftSegmentation( maskNegFilter->GetOutput(), rightFiducial, reconstructionKernel, numberOfVoxels, labelValue );
+        try
+        {
+            leftLung = RightLeftSegmentation( leftMaskedImage, flipIm ? rightFiducial : leftFiducial, reconstructionKernel, numberOfVoxels, labelValue );
+        }
+        catch( ... )
+        {
+            leftException = std::current_exception();
+        }
+    } );
+
+    try
+    {
+        rightLung = RightLeftSegmentation( rightMaskedImage, flipIm ? leftFiducial : rightFiducial, reconstructionKernel, numberOfVoxels, labelValue );
     }
-    else
+    catch( ... )
+    {
+        rightException = std::current_exception();
+    }
+    leftThread.join();
+
+    if( rightException )
+    {
+        std::rethrow_exception( rightException );
+    }
+    if( leftException )
     {
-        leftLung = RightLeftSegmentation( maskNegFilter->GetOutput(), leftFiducial, reconstructionKernel, numberOfVoxels, labelValue );
+        std::rethrow_exception( leftException );
     }
+    ReportProgress( 0.75 );
 				
+    ShapeLabelType::Pointer rightLabelConverter = ShapeLabelType::New();
+        
+    rightLabelConverter->SetInput( rightLung );
+    rightLabelConverter->SetInputForegroundValue( labelValue );
+    rightLabelConverter->Update();
+		
+    labelMap = rightLabelConverter->GetOutput();        
+
     ShapeLabelType::Pointer leftLabelConverter = ShapeLabelType::New();
 
     leftLabelConverter->SetInput( leftLung );
@@ -2072,15 +2191,31 @@ int main( int argc, char *argv[] )
 
     newStructElement.SetRadius( newRadius );
     newStructElement.CreateStructuringElement();
+
+    // The closing grows the airways by at most its radius and every hole filling iteration by at most one voxel,
+    // so outside the bounding region of the airways extended by these amounts the result is always background.
+    // The filters are applied only to this region (with one extra voxel for the neighborhood of the hole filling),
+    // which gives the same label as processing the whole volume.
+    const unsigned int holeFillingIterations = 10;
+
+    OutputImageType::RegionType airwayRegion = LabelBoundingRegion( pasteImage, labelValue );
+    airwayRegion.PadByRadius( newRadius[0] + holeFillingIterations + 2 );
+    airwayRegion.Crop( pasteImage->GetLargestPossibleRegion() );
+
+    outputROIFilterType::Pointer airwayROIFilter = outputROIFilterType::New();
+    airwayROIFilter->SetInput( pasteImage );
+    airwayROIFilter->SetRegionOfInterest( airwayRegion );
+    airwayROIFilter->Update();
 	
     //typedef itk::BinaryMorphologicalClosingImageFilter < OutputImageType, OutputImageType, StructuringElementType > CloseType;
     CloseType::Pointer newClosing = CloseType::New();
 
-    newClosing->SetInput( pasteImage );
+    newClosing->SetInput( airwayROIFilter->GetOutput() );
     newClosing->SetKernel( newStructElement );
     newClosing->SetForegroundValue( labelValue );
     newClosing->SetSafeBorder( 1 );
     newClosing->Update();
+    ReportProgress( 0.85 );
 	
     typedef itk::VotingBinaryIterativeHoleFillingImageFilter< OutputImageType > IterativeFillHolesFilterType;
     IterativeFillHolesFilterType::Pointer HoleFilling = IterativeFillHolesFilterType::New();
@@ -2094,7 +2229,7 @@ int main( int argc, char *argv[] )
     HoleFilling->SetBackgroundValue( 0 );
     HoleFilling->SetForegroundValue( labelValue );
     HoleFilling->SetMajorityThreshold( 1 );
-    HoleFilling->SetMaximumNumberOfIterations( 10 );
+    HoleFilling->SetMaximumNumberOfIterations( holeFillingIterations );
     HoleFilling->Update();
 
     typedef itk::GrayscaleFillholeImageFilter< OutputImageType, OutputImageType > GSFillHolesFilterType;
@@ -2104,12 +2239,20 @@ int main( int argc, char *argv[] )
     GSHoleFilling->SetFullyConnected(1);
     GSHoleFilling->Update();
 
+    OutputImageType::Pointer airwayLabel = OutputImageType::New();
+    airwayLabel->CopyInformation( pasteImage );
+    airwayLabel->SetRegions( pasteImage->GetLargestPossibleRegion() );
+    airwayLabel->Allocate();
+    airwayLabel->FillBuffer( 0 );
+    airwayLabel = Paste<OutputImageType>( GSHoleFilling->GetOutput(), airwayRegion.GetIndex(), airwayLabel );
+    ReportProgress( 0.95 );
+
     /** LABEL CREATION */
     typedef  itk::ImageFileWriter<OutputImageType> WriterType;
     WriterType::Pointer labelImage = WriterType::New();
 
     labelImage->SetFileName( label.c_str() );
-    labelImage->SetInput( GSHoleFilling->GetOutput() );
+    labelImage->SetInput( airwayLabel );
     labelImage->SetUseCompression(1);
 
     try